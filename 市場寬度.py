@@ -1,18 +1,38 @@
 import yfinance as yf
 import pandas as pd
 import twstock
-from datetime import datetime, timedelta
+from pathlib import Path
 import logging
+import logging.handlers
+import queue
 import numpy as np
 import matplotlib.pyplot as plt
 
-# 配置日誌
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# 配置日誌，寫檔與輸出交由背景執行緒處理，避免阻塞下載與計算
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.FileHandler('stock_analysis_pipeline.log', encoding='utf-8'),
+    logging.StreamHandler())
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s: %(message)s',
-                    handlers=[
-                        logging.FileHandler('stock_analysis_pipeline.log', encoding='utf-8'),
-                        logging.StreamHandler()
-                    ])
+                    handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener.start()
+
+# 每批次下載的股票數量
+BATCH_SIZE = 20
+# 收盤價快取目錄，每支股票一個 Parquet 檔
+CACHE_DIR = Path('cache')
 
 def get_taiwan_listed_stock_codes():
     """
@@ -29,70 +49,198 @@ def get_taiwan_listed_stock_codes():
         logging.error(f"獲取股票代碼時發生錯誤: {e}")
         return ['^TWII']
 
+def download_batch(batch, start_date, end_date):
+    """
+    批次下載一組股票的收盤價，回傳以日期為索引的 Series
+    """
+    stock_data = yf.download(" ".join(batch), start=start_date, end=end_date,
+                             group_by='ticker', threads=True, progress=False, auto_adjust=False)
+    if not stock_data.empty:
+        if not isinstance(stock_data.columns, pd.MultiIndex):
+            stock_data = pd.concat({batch[0]: stock_data}, axis=1)
+        stock_data.index = stock_data.index.tz_localize(None)
+        stock_data.index.name = 'Date'
+
+    closing_prices = {}
+    for stock_code in batch:
+        if stock_data.empty or stock_code not in stock_data.columns.get_level_values(0):
+            logging.warning(f"股票 {stock_code} 無法下載數據")
+            continue
+        close = stock_data[stock_code]['Close'].dropna()
+        if close.empty:
+            logging.warning(f"股票 {stock_code} 無法下載數據")
+            continue
+        closing_prices[stock_code] = close.rename(stock_code)
+    return closing_prices
+
+def load_cached_prices(stock_code):
+    """
+    讀取快取的收盤價，無快取、未安裝 pyarrow 或讀取失敗時回傳 None
+    """
+    if pyarrow is None:
+        return None
+    cache_file = CACHE_DIR / f"{stock_code}.parquet"
+    if not cache_file.exists():
+        return None
+    try:
+        return pd.read_parquet(cache_file, engine='pyarrow')['Close'].rename(stock_code)
+    except Exception as e:
+        logging.warning(f"股票 {stock_code} 快取讀取失敗，將重新下載: {e}")
+        return None
+
+def save_cached_prices(stock_code, prices):
+    """
+    將收盤價寫入快取，未安裝 pyarrow 時不做任何事
+    """
+    if pyarrow is None:
+        return
+    CACHE_DIR.mkdir(exist_ok=True)
+    prices.rename('Close').to_frame().to_parquet(CACHE_DIR / f"{stock_code}.parquet",
+                                                 engine='pyarrow', compression='zstd')
+
+def cache_matches(cached, prices):
+    """
+    比對快取與重新下載資料在重疊日期的收盤價，股票分割等歷史調整會使兩者不一致
+    最後一個快取日可能是盤中價格，不列入比對
+    """
+    overlap = cached.index[:-1].intersection(prices.index)
+    return np.allclose(cached[overlap], prices[overlap], rtol=1e-4)
+
+def update_closing_prices(stock_codes, fetch_start, end_date, all_closing_prices):
+    """
+    分批下載 fetch_start 之後的收盤價，與既有資料合併後寫入快取
+    回傳快取歷史價格與下載結果不一致、需要重新完整下載的股票
+    """
+    stale_codes = []
+    for i in range(0, len(stock_codes), BATCH_SIZE):
+        batch = stock_codes[i:i + BATCH_SIZE]
+        try:
+            closing_prices = download_batch(batch, fetch_start, end_date)
+        except Exception as e:
+            logging.error(f"股票 {', '.join(batch)} 下載失敗: {e}")
+            continue
+
+        for stock_code, prices in closing_prices.items():
+            cached = all_closing_prices.get(stock_code)
+            if cached is not None:
+                if not cache_matches(cached, prices):
+                    stale_codes.append(stock_code)
+                    continue
+                prices = pd.concat([cached, prices])
+                prices = prices[~prices.index.duplicated(keep='last')]
+            all_closing_prices[stock_code] = prices
+            try:
+                save_cached_prices(stock_code, prices)
+            except Exception as e:
+                logging.warning(f"股票 {stock_code} 快取寫入失敗: {e}")
+        logging.info(f"成功獲取 {len(closing_prices)}/{len(batch)} 支股票的收盤價數據")
+    return stale_codes
+
 def fetch_stock_prices(stock_codes):
     """
-    獲取近五年的收盤價數據
+    獲取近五年的收盤價數據，已快取的股票只下載最後快取日期之後的資料
+    已快取的股票若下載失敗，回傳的是未更新的快取資料
     """
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=365 * 5)
+    # yfinance 的 end 不含當日，因此取明日零時以納入今天的資料
+    end_date = pd.Timestamp.today().normalize() + pd.Timedelta(days=1)
+    start_date = end_date - pd.DateOffset(years=5)
     all_closing_prices = {}
-    
+    if pyarrow is None:
+        logging.warning("未安裝 pyarrow，本次執行不使用收盤價快取")
+
+    # 依下載起始日分組，快取日期相同的股票可以合併成同一批次
+    pending_codes = {}
     for stock_code in stock_codes:
-        try:
-            stock_data = yf.download(stock_code, start=start_date, end=end_date)
-            if stock_data.empty:
-                logging.warning(f"股票 {stock_code} 無法下載數據")
-                continue
-            closing_prices = stock_data['Close'].reset_index()
-            closing_prices['Date'] = closing_prices['Date'].dt.tz_localize(None)
-            closing_prices.columns = ['Date', stock_code]
-            all_closing_prices[stock_code] = closing_prices
-            logging.info(f"成功獲取 {stock_code} 的收盤價數據")
-        except Exception as e:
-            logging.error(f"股票 {stock_code} 下載失敗: {e}")
-    return all_closing_prices
+        cached = load_cached_prices(stock_code)
+        if cached is None or cached.empty:
+            fetch_start = start_date
+        else:
+            all_closing_prices[stock_code] = cached
+            # 從倒數第二個快取日開始下載：最後一日可能是盤中價格需要覆蓋，
+            # 倒數第二日則用來檢查歷史價格是否已被調整
+            fetch_start = cached.index[-2] if len(cached) > 1 else cached.index[-1]
+        pending_codes.setdefault(fetch_start, []).append(stock_code)
+
+    stale_codes = []
+    for fetch_start, codes in pending_codes.items():
+        stale_codes += update_closing_prices(codes, fetch_start, end_date, all_closing_prices)
+
+    if stale_codes:
+        logging.warning(f"股票 {', '.join(stale_codes)} 的歷史收盤價已調整，捨棄快取並重新下載")
+        for stock_code in stale_codes:
+            del all_closing_prices[stock_code]
+            try:
+                (CACHE_DIR / f"{stock_code}.parquet").unlink(missing_ok=True)
+            except OSError as e:
+                logging.warning(f"股票 {stock_code} 快取刪除失敗: {e}")
+        update_closing_prices(stale_codes, start_date, end_date, all_closing_prices)
+
+    # 依 stock_codes 的順序回傳，使輸出欄位順序不受快取狀態影響
+    closing_prices_in_range = {}
+    for stock_code in stock_codes:
+        if stock_code in all_closing_prices:
+            prices = all_closing_prices[stock_code]
+            closing_prices_in_range[stock_code] = prices[prices.index >= start_date]
+    return closing_prices_in_range
 
 def merge_closing_prices(all_closing_prices):
     """
     合併所有股票的收盤價數據
     """
-    merged_data = all_closing_prices['^TWII']
-    for stock_code, prices in all_closing_prices.items():
-        if stock_code != '^TWII':
-            merged_data = pd.merge(merged_data, prices, on='Date', how='left')
-    return merged_data
+    twii = all_closing_prices['^TWII']
+    stock_prices = [prices for stock_code, prices in all_closing_prices.items() if stock_code != '^TWII']
+    merged_data = pd.concat([twii] + stock_prices, axis=1, join='outer').sort_index()
+    return merged_data.reindex(twii.index)
+
+def write_excel(file_name, sheets):
+    """
+    將多個 DataFrame 寫入同一個 Excel 檔，有 xlsxwriter 時以 constant_memory 模式逐列寫出
+    """
+    if xlsxwriter is None:
+        with pd.ExcelWriter(file_name) as writer:
+            for sheet_name, sheet_df in sheets.items():
+                sheet_df.to_excel(writer, sheet_name=sheet_name)
+        return
+
+    # constant_memory 模式只能依列序寫入，pandas 的 to_excel 會逐欄寫入，因此自行逐列寫出
+    workbook = xlsxwriter.Workbook(file_name, {'constant_memory': True})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    for sheet_name, sheet_df in sheets.items():
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, [sheet_df.index.name] + list(sheet_df.columns))
+        values = sheet_df.to_numpy()
+        for row, (date, row_values) in enumerate(zip(sheet_df.index, values), start=1):
+            worksheet.write_datetime(row, 0, date.to_pydatetime(), date_format)
+            # 缺值寫成空白儲存格，逐列轉換以維持記憶體用量
+            worksheet.write_row(row, 1, [None if np.isnan(value) else value for value in row_values])
+    workbook.close()
 
 def analyze_stock_data(df):
     """
     分析台灣上市公司股價數據
     """
-    df['Date'] = pd.to_datetime(df['Date'])
-    df.set_index('Date', inplace=True)
+    if not isinstance(df.index, pd.DatetimeIndex):
+        df.index = pd.to_datetime(df.index)
     ma_windows = [20, 60, 120, 240]
-    ma_columns = {}
-
-    for column in df.columns:
-        if column != '^TWII':
-            for window in ma_windows:
-                ma_columns[f'{column}_MA{window}'] = df[column].rolling(window=window).mean()
 
-    ma_df = pd.DataFrame(ma_columns, index=df.index)
-    combined_df = pd.concat([df, ma_df], axis=1)
+    # 加權指數獨立出來，stock_df 只保留個股收盤價
+    twii = df['^TWII']
+    stock_df = df.drop(columns='^TWII')
+    prices = stock_df.to_numpy()
 
+    ma_frames = []
     ma_above_count = {}
-    for date in combined_df.index:
-        daily_counts = {}
-        for window in ma_windows:
-            companies_above_ma = 0
-            for column in combined_df.columns:
-                if column != '^TWII' and column.endswith(f'_MA{window}'):
-                    stock_column = column.replace(f'_MA{window}', '')
-                    if pd.notna(combined_df.loc[date, column]) and combined_df.loc[date, stock_column] > combined_df.loc[date, column]:
-                        companies_above_ma += 1
-            daily_counts[f'Above_MA{window}_Count'] = companies_above_ma
-        ma_above_count[date] = daily_counts
-
-    ma_count_df = pd.DataFrame.from_dict(ma_above_count, orient='index')
+    for window in ma_windows:
+        ma = stock_df.rolling(window=window).mean()
+        # NaN 比較結果為 False，因此尚未形成均線的日期不會被計入
+        ma_above_count[f'Above_MA{window}_Count'] = (prices > ma.to_numpy()).sum(axis=1)
+        ma_frames.append(ma.add_suffix(f'_MA{window}'))
+
+    # 欄位順序與原本一致：加權指數、各股收盤價，再依股票排列各均線
+    ma_df = pd.concat(ma_frames, axis=1)
+    ma_df = ma_df[[f'{column}_MA{window}' for column in stock_df.columns for window in ma_windows]]
+    combined_df = pd.concat([twii, stock_df, ma_df], axis=1)
+    ma_count_df = pd.DataFrame(ma_above_count, index=df.index.rename(None))
 
     fig, ax1 = plt.subplots(figsize=(15, 10))
     for window in ma_windows:
@@ -103,7 +251,7 @@ def analyze_stock_data(df):
     ax1.legend(loc='upper left')
 
     ax2 = ax1.twinx()
-    ax2.plot(combined_df.index, combined_df['^TWII'], color='red', linestyle='-', label='加權指數')
+    ax2.plot(twii.index, twii, color='red', linestyle='-', label='加權指數')
     ax2.set_ylabel('加權指數')
     ax2.set_ylim(10000, 26000)
     ax2.legend(loc='upper right')
@@ -113,9 +261,10 @@ def analyze_stock_data(df):
     plt.tight_layout()
     plt.savefig('stock_ma_analysis.png')
 
-    with pd.ExcelWriter('stock_analysis_results.xlsx') as writer:
-        combined_df.to_excel(writer, sheet_name='原始數據及移動平均線')
-        ma_count_df.to_excel(writer, sheet_name='移動平均線上漲公司數')
+    write_excel('stock_analysis_results.xlsx', {
+        '原始數據及移動平均線': combined_df,
+        '移動平均線上漲公司數': ma_count_df,
+    })
 
     logging.info("分析完成，結果已儲存為 'stock_analysis_results.xlsx' 和 'stock_ma_analysis.png'")
     return ma_count_df
@@ -128,9 +277,9 @@ def main():
         analysis_result = analyze_stock_data(merged_data)
         logging.info("完整流程執行成功")
     except Exception as e:
-        logging.error(f"程序執行失敗: {e}")
-        import traceback
-        traceback.print_exc()
+        logging.exception(f"程序執行失敗: {e}")
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()